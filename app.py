@@ -1,11 +1,21 @@
 import streamlit as st
+import dbm
+import hashlib
+import pickle
+import shelve
+import shutil
+import subprocess
 import tempfile
+import threading
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
-import google.generativeai as genai
-from google.generativeai import types
+from google import genai
+from google.genai import errors, types
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # 1. Load API key from Streamlit secrets
 API_KEY_GOOGLE = st.secrets["google"].get("api_key", None)
@@ -13,18 +23,72 @@ if not API_KEY_GOOGLE:
     st.error("Google API Key not found in secrets. Please set [google] api_key in secrets.toml.")
     st.stop()
 
-# 2. Configure Generative AI
-genai.configure(api_key=API_KEY_GOOGLE)
+# 2. Create the Gemini client (once per process, not on every rerun)
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key: str) -> genai.Client:
+    """Gemini client shared by every session, so its HTTP connections are reused."""
+    return genai.Client(api_key=api_key)
 
-# 3. Streamlit Page Configuration
-st.set_page_config(
-    page_title="Sage Creek Wrestling Analyzer",
-    page_icon="🤼",
-    layout="wide"
-)
+client = get_genai_client(API_KEY_GOOGLE)
+
+# Finished analyses and Gemini file names are kept here so they survive app restarts
+CACHE_DIR = Path.home() / ".cache" / "wrestling_analyzer"
+# Read-only/full disk, a dbm lock held by another process, or a corrupt shelf
+DISK_CACHE_ERRORS = (OSError, EOFError, pickle.UnpicklingError, *dbm.error)
+
+# Uploads larger than this are previewed only when asked, to keep reruns light
+PREVIEW_MAX_BYTES = 50 * 1024 * 1024
+
+# Cached Gemini file handles are re-uploaded once they are this close to expiring
+FILE_EXPIRY_MARGIN = timedelta(minutes=10)
+# Batch jobs may run up to 24 hours after queueing, plus up to an hour the handle can sit in the resource cache
+BATCH_FILE_MARGIN = timedelta(hours=25)
+
+# Uploads larger than this are re-encoded to 720p before going to Gemini (needs ffmpeg)
+TRANSCODE_MIN_BYTES = 50 * 1024 * 1024
+TRANSCODE_TIMEOUT = 600
+
+# Model used for both interactive and batch analyses
+GEMINI_MODEL = "gemini-2.0-flash"  # or whichever 2.0 model you have access to
+
+# Sampling settings for the analysis (also part of the analysis cache key)
+GENERATION_SETTINGS = {"temperature": 0.2, "max_output_tokens": 8192}
+
+# File processing poll settings (seconds)
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 4.0
+POLL_TIMEOUT = 300
+
+# "Coach Steele" persona, kept byte-identical across requests so Gemini can reuse the cached prefix.
+# This prompt encourages the LLM to reference fundamental wrestling technique.
+SYSTEM_INSTRUCTION = """You are Coach David Steele, wrestling coach at Sage Creek High School.
+You deliver intense, but constructive wrestling feedback based on Cary Kolat’s philosophy.
+Your analysis is direct yet encouraging. Focus on stance, shots, finishes, top control, bottom escapes,
+and overall mindset.
+"""
 
-# 4. Page Title / Branding
-st.markdown("""
+# We'll have the LLM produce a single detailed analysis. Only {user_notes} varies per request,
+# and it stays last so everything before it is a stable prefix for Gemini's prompt cache.
+USER_INSTRUCTION_TEMPLATE = """
+A wrestling video has been uploaded for your analysis. 
+
+Please identify the main technical strengths and weaknesses in the athlete's performance, referencing fundamental
+wrestling skills. Provide 2-3 key focal points to improve, plus recommended drills or practice ideas.
+Close with a motivating, "Coach Steele–style" message.
+
+User notes: {user_notes}
+"""
+
+# Session state defaults; mutable containers are factories so each session gets its own
+SESSION_DEFAULTS = {
+    "video_file_id": None,
+    "video_hash": None,
+    "gemini_files": dict,
+    "batch_jobs": list,
+}
+
+# Static page markup
+CSS_MAIN = """
     <style>
     .stApp {
         max-width: 1000px;
@@ -73,9 +137,9 @@ st.markdown("""
         font-size: 0.9rem;
     }
     </style>
-""", unsafe_allow_html=True)
+"""
 
-st.markdown("""
+HEADER_HTML = """
 <div class="main-header">
     <img src="https://files.smartsites.parentsquare.com/3483/design_img__ljsgi1.png" alt="Sage Creek Logo">
     <div>
@@ -83,7 +147,32 @@ st.markdown("""
         <h3 style="margin: 0; font-weight: normal;">Coach Steele Wrestling Analyzer</h3>
     </div>
 </div>
-""", unsafe_allow_html=True)
+"""
+
+FOOTER_HTML = """
+<div class="footer">
+    <p>Sage Creek High School | 3900 Bobcat Blvd. | Carlsbad, CA 92010<br>
+    Phone: 760-331-6600 • Email: office.schs@carlsbadusd.net<br>
+    Contents © 2025 Sage Creek High School</p>
+</div>
+"""
+
+ANALYSIS_OPEN = '<div class="analysis-section">'
+ANALYSIS_CLOSE = '</div>'
+
+# 3. Streamlit Page Configuration
+st.set_page_config(
+    page_title="Sage Creek Wrestling Analyzer",
+    page_icon="🤼",
+    layout="wide"
+)
+
+# 4. Page Title / Branding (styles and header go out as one element)
+st.markdown(CSS_MAIN + HEADER_HTML, unsafe_allow_html=True)
+
+# Per-session state: hash of the current upload, its Gemini file handles and queued batch jobs
+for key, default in SESSION_DEFAULTS.items():
+    st.session_state.setdefault(key, default() if callable(default) else default)
 
 # 5. Main UI
 st.subheader("Upload a Wrestling Video")
@@ -100,99 +189,370 @@ user_prompt = st.text_area(
     height=100
 )
 
-def analyze_wrestling_video(video_path: str, user_notes: str):
+queue_batch = st.checkbox(
+    "Queue for batch analysis (about half the cost, results within 24 hours)",
+    help="Useful when reviewing a whole roster's clips that don't need feedback right away."
+)
+
+def wait_for_processing(uploaded_file, timeout: float = POLL_TIMEOUT):
+    """
+    Polls a Gemini file until it leaves 'PROCESSING', backing off exponentially
+    so short clips return quickly and long ones don't flood files.get().
+    """
+    delay = POLL_INITIAL_DELAY
+    deadline = time.monotonic() + timeout
+    while uploaded_file.state == "PROCESSING":
+        if time.monotonic() > deadline:
+            raise TimeoutError("Video processing timed out. Please try a shorter clip.")
+        time.sleep(delay)
+        delay = min(delay * 1.7, POLL_MAX_DELAY)
+        uploaded_file = client.files.get(name=uploaded_file.name)
+    return uploaded_file
+
+def should_shrink(video_file) -> bool:
+    """Whether an upload is large enough to re-encode, and ffmpeg is available to do it."""
+    return video_file.size > TRANSCODE_MIN_BYTES and shutil.which("ffmpeg") is not None
+
+def shrink_video(video_file):
     """
-    Uploads the local video file to Google Generative AI,
-    waits for processing, and then passes a prompt for 'Coach Steele' style analysis.
+    Re-encodes large uploads to 720p H.264 with ffmpeg so they upload and process
+    faster. Returns the path of the smaller copy, or None when the clip is small,
+    ffmpeg isn't installed, or re-encoding fails or doesn't help.
     """
+    if not should_shrink(video_file):
+        return None
+
+    # ffmpeg needs a seekable input for MP4/MOV, so spill the upload to disk first
     try:
-        # 1. Upload the video to Google's generative AI
-        uploaded_file = genai.files.upload(path=video_path)
-        # 2. Poll until the file is 'ACTIVE' or 'FAILED'
-        while uploaded_file.state == "PROCESSING":
-            st.write("Waiting for video to be processed...")
-            time.sleep(3)
-            uploaded_file = genai.files.get(name=uploaded_file.name)
-
-        if uploaded_file.state == "FAILED":
-            st.error("File upload failed. Please try a different video or check your file size limits.")
-            return
-
-        # 3. Construct a "Coach Steele" prompt
-        # This prompt encourages the LLM to reference fundamental wrestling technique.
-        system_instruction = """You are Coach David Steele, wrestling coach at Sage Creek High School.
-You deliver intense, but constructive wrestling feedback based on Cary Kolat’s philosophy.
-Your analysis is direct yet encouraging. Focus on stance, shots, finishes, top control, bottom escapes,
-and overall mindset.
-"""
+        fd, source_name = tempfile.mkstemp(suffix=Path(video_file.name).suffix)
+    except OSError:
+        return None
+    source_path = Path(source_name)
+    output_path = source_path.with_name(f"{source_path.stem}_720p.mp4")
+    try:
+        video_file.seek(0)
+        with os.fdopen(fd, "wb") as source:
+            shutil.copyfileobj(video_file, source, length=1024 * 1024)
+        subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", "-i", str(source_path),
+             # Cap the short side so portrait phone clips land at 720x1280, not 405x720
+             "-vf", "scale='if(gt(iw,ih),-2,min(720,iw))':'if(gt(iw,ih),min(720,ih),-2)'", "-c:v", "libx264", "-preset", "veryfast", "-crf", "28",
+             "-c:a", "aac", "-b:a", "64k", str(output_path)],
+            check=True, capture_output=True, timeout=TRANSCODE_TIMEOUT
+        )
+        shrunk = output_path.stat().st_size < video_file.size
+    except (subprocess.SubprocessError, OSError):
+        # Full temp dir, ffmpeg failure or no output: fall back to uploading the original clip
+        shrunk = False
+    finally:
+        source_path.unlink(missing_ok=True)
 
-        # We'll have the LLM produce a single detailed analysis. 
-        user_instruction = f"""
-A wrestling video has been uploaded for your analysis. 
-User notes: {user_notes}
+    if not shrunk:
+        output_path.unlink(missing_ok=True)
+        return None
+    return output_path
 
-Please identify the main technical strengths and weaknesses in the athlete's performance, referencing fundamental
-wrestling skills. Provide 2-3 key focal points to improve, plus recommended drills or practice ideas.
-Close with a motivating, "Coach Steele–style" message.
-"""
+def is_still_active(uploaded_file, refresh: bool = True, margin: timedelta = FILE_EXPIRY_MARGIN) -> bool:
+    """
+    Checks that a cached Gemini file handle can still be referenced for at least
+    `margin`, using its expiry time when the SDK reports one. Otherwise asks the
+    Files API, or with refresh=False trusts the state of a handle that was just fetched.
+    """
+    expires = getattr(uploaded_file, "expiration_time", None)
+    if expires is not None:
+        if expires.tzinfo is None:
+            expires = expires.replace(tzinfo=timezone.utc)
+        return expires > datetime.now(timezone.utc) + margin
+    if not refresh:
+        return uploaded_file.state == "ACTIVE"
+    try:
+        return client.files.get(name=uploaded_file.name).state == "ACTIVE"
+    except Exception:
+        return False
+
+@st.cache_resource(ttl=3600, show_spinner=False, validate=is_still_active)
+def get_or_upload_gemini_file(video_sha: str, _video_file, margin: timedelta = FILE_EXPIRY_MARGIN):
+    """
+    Streams the uploaded video (shrunk first if it is large) to Google Generative AI
+    once per content hash and waits until it is 'ACTIVE'. Repeat analyses of the
+    same clip reuse the handle, including uploads made before a restart, as long
+    as it has at least `margin` left before Gemini deletes it.
+    """
+    # Reuse a file uploaded by an earlier session or before a restart
+    known_name = load_cached("gemini_files", video_sha)
+    if known_name:
+        try:
+            known_file = client.files.get(name=known_name)
+            if known_file.state == "ACTIVE" and is_still_active(known_file, refresh=False, margin=margin):
+                return known_file
+        except errors.ClientError as e:
+            # Deleted or expired server-side (the Files API reports some as 403); upload again
+            if e.code not in (403, 404):
+                raise
+
+    shrunk_path = shrink_video(_video_file)
+    try:
+        if shrunk_path:
+            upload = client.files.upload(
+                file=str(shrunk_path),
+                config={"mime_type": "video/mp4", "display_name": _video_file.name}
+            )
+        else:
+            _video_file.seek(0)
+            upload = client.files.upload(
+                file=_video_file,
+                config={"mime_type": _video_file.type or "video/mp4", "display_name": _video_file.name}
+            )
+    finally:
+        if shrunk_path:
+            shrunk_path.unlink(missing_ok=True)
+    uploaded_file = wait_for_processing(upload)
 
-        # 4. Generate content using the video + user prompt
-        response = genai.models.generate_content(
-            model="gemini-2.0-flash",  # or whichever 2.0 model you have access to
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_uri(
-                            file_uri=uploaded_file.uri,
-                            mime_type=uploaded_file.mime_type
-                        )
-                    ]
-                ),
-                user_instruction
-            ],
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                temperature=0.2,
-                max_output_tokens=8192
+    if uploaded_file.state == "FAILED":
+        # Raising keeps the failed handle out of the cache
+        raise RuntimeError("File upload failed. Please try a different video or check your file size limits.")
+    save_cached("gemini_files", video_sha, uploaded_file.name)
+    return uploaded_file
+
+@st.cache_resource(show_spinner=False)
+def get_disk_cache(name: str):
+    """
+    Disk-backed shelf (finished analyses, Gemini file names) shared by all
+    sessions and kept across app restarts.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    return shelve.open(str(CACHE_DIR / name))
+
+@st.cache_resource(show_spinner=False)
+def get_disk_cache_lock() -> threading.Lock:
+    """Serialises access to the cache shelves across concurrent sessions."""
+    return threading.Lock()
+
+def analysis_cache_key(video_sha: str, user_notes: str) -> str:
+    """
+    Keys a finished analysis on the video and notes plus everything that shapes
+    the response (model, prompt text, generation settings), so editing any of
+    those stops serving analyses cached on disk under the old setup.
+    """
+    prompt_setup = "|".join([
+        GEMINI_MODEL,
+        SYSTEM_INSTRUCTION,
+        USER_INSTRUCTION_TEMPLATE,
+        repr(sorted(GENERATION_SETTINGS.items())),
+    ])
+    prompt_sha = hashlib.sha256(prompt_setup.encode()).hexdigest()
+    return hashlib.sha256(f"{prompt_sha}|{video_sha}|{user_notes}".encode()).hexdigest()
+
+def load_cached(name: str, key: str):
+    """Returns the cached value, or None on a miss or if the shelf is unusable."""
+    try:
+        with get_disk_cache_lock():
+            return get_disk_cache(name).get(key)
+    except DISK_CACHE_ERRORS:
+        return None
+
+def save_cached(name: str, key: str, value):
+    """Stores a value if the shelf is usable; the cache never blocks an analysis."""
+    try:
+        with get_disk_cache_lock():
+            shelf = get_disk_cache(name)
+            shelf[key] = value
+            shelf.sync()
+    except DISK_CACHE_ERRORS:
+        pass
+
+@st.cache_resource(show_spinner=False)
+def get_generation_config():
+    """The analysis GenerateContentConfig, validated once and shared by every request."""
+    return types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION, **GENERATION_SETTINGS)
+
+def build_analysis_request(uploaded_file, user_notes: str) -> dict:
+    """
+    Builds the 'Coach Steele' generate_content arguments (contents + config) for
+    the uploaded file, shared by the streaming and batch paths.
+    """
+    # 3. Construct a "Coach Steele" prompt
+    user_instruction = USER_INSTRUCTION_TEMPLATE.format(user_notes=user_notes)
+
+    return {
+        "contents": [
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_uri(
+                        file_uri=uploaded_file.uri,
+                        mime_type=uploaded_file.mime_type
+                    )
+                ]
             ),
-        )
+            user_instruction
+        ],
+        "config": get_generation_config(),
+    }
+
+def stream_analysis(uploaded_file, user_notes: str):
+    """
+    Passes a prompt for 'Coach Steele' style analysis of the uploaded file and
+    yields the response text as Gemini generates it.
+    """
+    # 4. Stream content using the video + user prompt
+    response = client.models.generate_content_stream(
+        model=GEMINI_MODEL,
+        **build_analysis_request(uploaded_file, user_notes)
+    )
 
-        # 5. Return the final text
-        return response.text
+    # 5. Yield the text as it arrives
+    for chunk in response:
+        if chunk.text:
+            yield chunk.text
+
+def submit_batch_analysis(uploaded_file, video_sha: str, user_notes: str) -> str:
+    """
+    Queues the analysis on the Gemini Batch API (lower cost, results within
+    24 hours) and returns the batch job name.
+    """
+    job = client.batches.create(
+        model=GEMINI_MODEL,
+        src=[build_analysis_request(uploaded_file, user_notes)],
+        config={"display_name": f"wrestler_{video_sha[:16]}"}
+    )
+    return job.name
+
+def show_batch_result(job_name: str):
+    """Checks a batch job and renders its analysis once it has finished."""
+    try:
+        job = client.batches.get(name=job_name)
+        if job.state == "JOB_STATE_SUCCEEDED":
+            # A finished job can still carry a per-request error instead of a response
+            result = job.dest.inlined_responses[0]
+            if result.error or result.response is None:
+                st.error(f"Batch job finished without an analysis ({result.error}). Please analyze the video again.")
+                return
+            st.markdown(ANALYSIS_OPEN, unsafe_allow_html=True)
+            st.subheader("Coach Steele's Analysis")
+            st.write(result.response.text)
+            st.markdown(ANALYSIS_CLOSE, unsafe_allow_html=True)
+        elif job.state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+            st.error(f"Batch job ended without a result ({job.state}). Please analyze the video again.")
+        else:
+            st.info(f"Batch job is still running ({job.state}). Check back later.")
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
+
+@st.cache_resource(show_spinner=False)
+def get_background_executor() -> ThreadPoolExecutor:
+    """Process-wide worker pool for blocking Gemini calls."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def run_with_status(message: str, fn, *args):
+    """
+    Runs fn(*args) on a worker thread while the script thread keeps an
+    elapsed-time status line updated, then returns its result.
+    """
+    ctx = get_script_run_ctx()
+
+    def _call():
+        # Let cached functions on the worker see this session's script run
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+
+    future = get_background_executor().submit(_call)
+    status = st.empty()
+    start = time.monotonic()
+    while not future.done():
+        elapsed = int(time.monotonic() - start)
+        status.markdown(f'<p class="processing-status">{message} ({elapsed}s)</p>', unsafe_allow_html=True)
+        wait([future], timeout=0.5)
+    status.empty()
+    return future.result()
+
+def upload_video(video_file, video_sha: str, margin: timedelta = FILE_EXPIRY_MARGIN):
+    """
+    Returns the ACTIVE Gemini file for this upload, reusing this session's handle
+    when it stays available for at least `margin`.
+    """
+    # 1-2. Upload the video and wait until it is 'ACTIVE' (cached by content hash)
+    uploaded_file = st.session_state.gemini_files.get(video_sha)
+    if uploaded_file is None or not is_still_active(uploaded_file, margin=margin):
+        # Whether a transcode actually runs is only known after the cache lookups on the worker
+        if should_shrink(video_file):
+            message = "Preparing your wrestling video (large clips can take a few minutes)..."
+        else:
+            message = "Uploading and processing your wrestling video..."
+        uploaded_file = run_with_status(message, get_or_upload_gemini_file, video_sha, video_file, margin)
+        st.session_state.gemini_files[video_sha] = uploaded_file
+    return uploaded_file
+
+def queue_wrestling_video(video_file, video_sha: str, user_notes: str):
+    """Uploads the video and queues its analysis as a Gemini batch job."""
+    try:
+        job_name = submit_batch_analysis(upload_video(video_file, video_sha, BATCH_FILE_MARGIN), video_sha, user_notes)
+        st.session_state.batch_jobs.append(job_name)
+        st.success(f"Queued for batch analysis as `{job_name}`. Check back under 'Batch Analyses'.")
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
+
+def analyze_wrestling_video(video_file, video_sha: str, user_notes: str):
+    """
+    Renders Coach Steele's analysis of the uploaded video, streaming it as it
+    is generated, and returns the final text. Prior uploads and analyses of the
+    same bytes are reused.
+    """
+    cache_key = analysis_cache_key(video_sha, user_notes)
+    try:
+        cached = load_cached("analyses", cache_key)
+        if cached:
+            chunks = [cached]
+        else:
+            chunks = stream_analysis(upload_video(video_file, video_sha), user_notes)
+
+        st.markdown(ANALYSIS_OPEN, unsafe_allow_html=True)
+        st.subheader("Coach Steele's Analysis")
+        output = st.write_stream(chunks)
+        st.markdown(ANALYSIS_CLOSE, unsafe_allow_html=True)
+
+        if output and not cached:
+            save_cached("analyses", cache_key, output)
+        return output
 
     except Exception as e:
         st.error(f"An error occurred: {e}")
         return None
-    finally:
-        # Cleanup local file
-        Path(video_path).unlink(missing_ok=True)
 
 # Action: If user clicks "Analyze"
 if video_file:
-    st.video(video_file, format="video/mp4")
+    # Large clips are only previewed on request; st.video re-registers the bytes on every rerun
+    if video_file.size <= PREVIEW_MAX_BYTES or st.checkbox("Show video preview"):
+        st.video(video_file, format="video/mp4")
 
     if st.button("Analyze Video"):
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_video:
-            temp_video.write(video_file.read())
-            video_path = temp_video.name
+        # Hash each upload once per session rather than on every click
+        if st.session_state.video_file_id != video_file.file_id:
+            st.session_state.video_hash = hashlib.sha256(video_file.getbuffer()).hexdigest()
+            st.session_state.video_file_id = video_file.file_id
+        video_sha = st.session_state.video_hash
 
-        st.write("Analyzing your wrestling video...")
-
-        output = analyze_wrestling_video(video_path, user_prompt)
-        if output:
-            st.markdown('<div class="analysis-section">', unsafe_allow_html=True)
-            st.subheader("Coach Steele's Analysis")
-            st.write(output)
-            st.markdown('</div>', unsafe_allow_html=True)
+        if queue_batch:
+            queue_wrestling_video(video_file, video_sha, user_prompt)
+        else:
+            analyze_wrestling_video(video_file, video_sha, user_prompt)
 else:
     st.info("Please upload a video to get started.")
 
+# Batch results can be checked from any later session by job name
+@st.fragment
+def batch_analyses_panel():
+    """Batch lookup widgets; interacting with them reruns only this panel."""
+    with st.expander("Batch Analyses"):
+        batch_job_name = st.text_input(
+            "Batch job name",
+            value=st.session_state.batch_jobs[-1] if st.session_state.batch_jobs else "",
+            placeholder="batches/..."
+        )
+        if st.button("Check Batch Status") and batch_job_name:
+            show_batch_result(batch_job_name)
+
+batch_analyses_panel()
+
 # 6. Footer
-st.markdown("""
-<div class="footer">
-    <p>Sage Creek High School | 3900 Bobcat Blvd. | Carlsbad, CA 92010<br>
-    Phone: 760-331-6600 • Email: office.schs@carlsbadusd.net<br>
-    Contents © 2025 Sage Creek High School</p>
-</div>
-""", unsafe_allow_html=True)
+st.markdown(FOOTER_HTML, unsafe_allow_html=True)